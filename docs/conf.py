@@ -49,6 +49,7 @@ autodoc_mock_imports = [
     'imageio',
     'lxml',
     'matplotlib',
+    'numba',
     'PIL',
     'progressbar',
     'pymongo',
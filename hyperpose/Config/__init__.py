@@ -11,6 +11,7 @@ update_config,update_train,update_eval,update_test,update_model,update_data,upda
 #default train
 update_train.optim_type=OPTIM.Adam
 update_train.kungfu_option = KUNGFU.Sync_avg
+update_train.mixed_precision_flag = False
 
 #defualt model config
 update_model.model_type=MODEL.Openpose
@@ -36,6 +37,8 @@ update_data.useradd_train_targets=None
 update_data.domainadapt_flag=False
 update_data.domainadapt_scale_rate=1
 update_data.domainadapt_train_img_paths=None
+#decoded dataset snapshot
+update_data.snapshot_dir=None
 #default pretrain config
 update_pretrain=edict()
 
@@ -375,6 +378,45 @@ def set_kungfu_option(kungfu_option):
     '''
     update_train.kungfu_option=kungfu_option
 
+def set_xla_flag(xla_flag):
+    '''set whether to compile the training step with XLA
+
+    when enabled, the forward, loss and gradient computation of each training step
+    are compiled by XLA into fused kernels. models whose loss relies on dynamically
+    shaped tensors(e.g. boolean masking) should disable it.
+
+    Parameters
+    ----------
+    arg1 : bool
+        True to enable XLA compilation of the training step, False to disable it
+    
+    Returns
+    -------
+    None
+    '''
+    update_train.xla_flag=xla_flag
+
+def set_mixed_precision_flag(mixed_precision_flag):
+    '''set whether to train with mixed precision
+
+    when enabled, the float32 ops of the training step are rewritten into float16 ops where
+    it is numerically safe, and the loss is dynamically scaled to avoid gradient underflow.
+    model weights are kept in float32. this needs a gpu with float16 tensor cores(Volta or newer).
+    as the rewrite is done on the tensorflow graph, xla(see set_xla_flag) is disabled when
+    mixed precision is enabled.
+
+    Parameters
+    ----------
+    arg1 : bool
+        True to enable mixed precision training, False to disable it
+        default: False
+    
+    Returns
+    -------
+    None
+    '''
+    update_train.mixed_precision_flag=mixed_precision_flag
+
 #data configure api
 def set_dataset_type(dataset_type):
     '''set the dataset for train and evaluate
@@ -479,6 +521,34 @@ def set_dataset_filter(dataset_filter):
     '''
     update_data.dataset_filter=dataset_filter
 
+def set_snapshot_dir(snapshot_dir):
+    '''set the directory to snapshot the decoded training images
+
+    when set, the training images and masks are decoded once in the first epoch and written
+    to this directory, the following epochs read them back instead of
+    decoding the jpeg files and masks again. the snapshot takes much disk space (about the size
+    of the uncompressed images), thus it should be on a fast and large disk.
+
+    each snapshot is stored in a sub-directory keyed by a hash of the training image paths
+    and annotations, so changing the dataset type, version, filter or user added data creates
+    a new snapshot instead of reading a stale one. the outdated sub-directories are not removed
+    automatically.
+
+    note that with snapshot, every epoch replays the sample order of the first epoch, which is
+    only reshuffled within a window of 512 samples.
+
+    Parameters
+    ----------
+    arg1 : String
+        a string indicates the path of the snapshot directory,
+        default: None (snapshot disabled)
+    
+    Returns
+    -------
+    None
+    '''
+    update_data.snapshot_dir=snapshot_dir
+
 # interval APIs
 # configure log interval
 def set_log_interval(log_interval):
@@ -541,6 +611,9 @@ def set_pretrain(enable):
 def set_pretrain_dataset_path(pretrain_dataset_path):
     update_pretrain.pretrain_dataset_path=pretrain_dataset_path
 
+def set_pretrain_xla_flag(xla_flag):
+    update_pretrain.xla_flag=xla_flag
+
 def info(msg):
     info_logger = logging.getLogger("INFO")
     info_logger.info(msg)
\ No newline at end of file
@@ -34,6 +34,8 @@ train.lr_decay_every_step = 136120
 train.lr_decay_factor = 0.666
 train.weight_decay_factor = 2e-4
 train.train_type=TRAIN.Single_train
+# compile the training step with XLA
+train.xla_flag=True
 train.vis_dir=f"./save_dir/{model.model_name}/train_vis_dir"
 
 #eval configuration
@@ -34,6 +34,8 @@ train.lr_decay_steps=[777920,848640]
 train.lr_decay_duration=35360
 train.weight_decay_factor = 1e-5
 train.train_type=TRAIN.Single_train
+# the pifpaf loss selects valid fields with boolean masks, whose dynamic shapes XLA can't compile
+train.xla_flag=False
 train.vis_dir=f"./save_dir/{model.model_name}/train_vis_dir"
 
 #eval configuration
@@ -38,6 +38,8 @@ train.lr_init = 1e-4  # initial learning rate
 train.lr_decay_factor=0.9
 train.weight_decay_factor = 5e-4
 train.train_type=TRAIN.Single_train
+# compile the training step with XLA
+train.xla_flag=True
 train.vis_dir = f"./save_dir/{model.model_name}/train_vis_dir"
 
 #eval configuration
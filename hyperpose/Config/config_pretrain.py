@@ -13,3 +13,4 @@ pretrain.pretrain_dataset_path="./data/imagenet"
 pretrain.pretrain_model_dir="./save_dir/pretrain_backbone"
 pretrain.val_num=20000
 pretrain.lr_decay_step=170000
+pretrain.xla_flag=True
@@ -3,6 +3,9 @@ import numpy as np
 import tensorflow as tf
 import tensorlayer as tl
 
+# augmentation runs in parallel tf.data workers, disable the opencv thread pool to avoid oversubscription
+cv2.setNumThreads(0)
+
 class BasicAugmentor:
     def __init__(self,hin,win,angle_min=-30,angle_max=30,zoom_min=0.5,zoom_max=0.8,flip_list=None, *args, **kargs):
         self.hin=hin
@@ -13,17 +16,21 @@ class BasicAugmentor:
         self.zoom_max=zoom_max
         self.flip_list=flip_list
     
+    def get_transform_matrix(self,image_h,image_w):
+        # rotate and zoom around the image center
+        angle=np.random.uniform(self.angle_min,self.angle_max)  # original paper: -40~40
+        zoom=np.random.uniform(self.zoom_min,self.zoom_max)  # original paper: 0.5~1.1
+        transform_matrix=cv2.getRotationMatrix2D(((image_w-1)/2,(image_h-1)/2),angle,zoom)
+        return transform_matrix
+
     def process(self,image,annos,mask,bbxs=None):
         # get transform matrix
         image_h,image_w,_=image.shape
-        M_rotate = tl.prepro.affine_rotation_matrix(angle=(-30, 30))  # original paper: -40~40
-        M_zoom = tl.prepro.affine_zoom_matrix(zoom_range=(0.5, 0.8))  # original paper: 0.5~1.1
-        M_combined = M_rotate.dot(M_zoom)
-        transform_matrix = tl.prepro.transform_matrix_offset_center(M_combined, x=image_w, y=image_h)
+        transform_matrix=self.get_transform_matrix(image_h,image_w)
         # apply data augmentation
-        image = tl.prepro.affine_transform_cv2(image, transform_matrix)
+        image = cv2.warpAffine(image, transform_matrix, (image_w,image_h), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT)
         annos = tl.prepro.affine_transform_keypoints(annos, transform_matrix)
-        mask = tl.prepro.affine_transform_cv2(mask, transform_matrix, border_mode='replicate')
+        mask = cv2.warpAffine(mask, transform_matrix, (image_w,image_h), flags=cv2.INTER_NEAREST, borderMode=cv2.BORDER_REPLICATE)
         if(self.flip_list!=None):
             image, annos, mask = tl.prepro.keypoint_random_flip(image, annos, mask, prob=0.5, flip_list=self.flip_list)
         image, annos, mask = tl.prepro.keypoint_resize_random_crop(image, annos, mask, size=(self.hin, self.win))
@@ -59,12 +66,9 @@ class BasicAugmentor:
         # print(f"process_only_image dtype:{image.dtype} shape:{image.shape}")
         # get transform matrix
         image_h,image_w,_=image.shape
-        M_rotate = tl.prepro.affine_rotation_matrix(angle=(-30, 30))  # original paper: -40~40
-        M_zoom = tl.prepro.affine_zoom_matrix(zoom_range=(0.5, 0.8))  # original paper: 0.5~1.1
-        M_combined = M_rotate.dot(M_zoom)
-        transform_matrix = tl.prepro.transform_matrix_offset_center(M_combined, x=image_w, y=image_h)
+        transform_matrix=self.get_transform_matrix(image_h,image_w)
         # apply data augmentation
-        image = tl.prepro.affine_transform_cv2(image, transform_matrix)
+        image = cv2.warpAffine(image, transform_matrix, (image_w,image_h), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT)
         image, _, _ = tl.prepro.keypoint_resize_random_crop(image, [], None, size=(self.hin, self.win))
         return image
     
\ No newline at end of file
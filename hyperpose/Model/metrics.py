@@ -42,6 +42,15 @@ class TimeMetric:
         self.start_time=cur_time
         return cur_time-last_time
 
+class MetricRecorder:
+    # collects metric tensors inside a tf.function, the collected values are
+    # returned from the graph and fed into a MetricManager afterwards
+    def __init__(self):
+        self.metric_dict={}
+
+    def update(self,metric_name,metric_value):
+        self.metric_dict[metric_name]=metric_value
+
 class MetricManager:
     def __init__(self,debug=False):
         self.debug=debug
@@ -72,10 +81,15 @@ class MetricManager:
         msg.replace("\n\n","\n")
         return msg
     
+    def update_dict(self,metric_dict):
+        for metric_name,metric_value in metric_dict.items():
+            self.update(metric_name,metric_value)
+    
     def start_timing(self):
         self.timer.start_timing()
     
-    def report_timing(self):
+    def report_timing(self,step_num=1):
+        # average time of the steps since the last timing
         msg=""
-        msg+=f"time:{self.timer.report_timing():.8f}"
+        msg+=f"time:{self.timer.report_timing()/step_num:.8f}"
         return msg
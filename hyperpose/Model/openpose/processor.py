@@ -20,6 +20,9 @@ class PreProcessor(BasicPreProcessor):
         self.parts=parts
         self.limbs=limbs
         self.colors=colors if (colors!=None) else (len(self.parts)*[[0,255,0]])
+        # compile the numba target generation kernels before they are used in the data pipeline
+        get_conf_map([], self.hin, self.win, self.hout, self.wout, self.parts, self.limbs)
+        get_paf_map([], self.hin, self.win, self.hout, self.wout, self.parts, self.limbs)
 
     def process(self, annos, mask, bbxs):
         conf_map = get_conf_map(annos, self.hin, self.win, self.hout, self.wout, self.parts, self.limbs, data_format="channels_first")
@@ -5,6 +5,7 @@
 import os
 import math
 import logging
+import numba
 import numpy as np
 import tensorflow as tf
 
@@ -35,14 +36,7 @@ def get_conf_map(annos, height, width, hout, wout, parts, limbs, data_format="ch
     joints_heatmap = np.zeros((n_pos, hout, wout), dtype=np.float32)
     stride=height/hout
     # among all people
-    for joint in annos:
-        # generate heatmap for every keypoints
-        # loop through all people and keep the maximum
-
-        for i, point in enumerate(joint):
-            if point[0] < 0 or point[1] < 0:
-                continue
-            joints_heatmap = put_heatmap(joints_heatmap, i, point, stride, 7.0)
+    build_heatmap(annos_to_kpts(annos), stride, 7.0, joints_heatmap)
 
     # 0: joint index, 1:y, 2:x
     joints_heatmap[-1, :, :] = np.clip(1 - np.amax(joints_heatmap, axis=0), 0.0, 1.0)
@@ -52,40 +46,38 @@ def get_conf_map(annos, height, width, hout, wout, parts, limbs, data_format="ch
         joints_heatmap=np.transpose(joints_heatmap,[1,2,0])
     return joints_heatmap
 
-def put_heatmap(heatmap, plane_idx, center, stride, sigma):
-    """
-
-    Parameters
-    -----------
-
-
-    Returns
-    --------
-
-
-    """
-    center_x,center_y=center
-    _,hout,wout=heatmap.shape[:3]
-
+def annos_to_kpts(annos):
+    """convert keypoint annotations of people into an array of shape [n_person, n_kpt, 2]"""
+    if(len(annos)==0):
+        return np.zeros(shape=(0,0,2), dtype=np.float64)
+    return np.array([np.asarray(joint)[:,:2] for joint in annos], dtype=np.float64)
+
+@numba.njit(fastmath=True, cache=True, nogil=True)
+def build_heatmap(kpts, stride, sigma, heatmap):
+    """put gaussian peaks of all keypoints onto heatmap, taking the maximum over all people"""
+    n_person, n_kpt = kpts.shape[0], kpts.shape[1]
+    hout, wout = heatmap.shape[1], heatmap.shape[2]
     thresh = 4.6052
     offset = stride/2-0.5
     exp_factor = 1/(2*sigma*sigma)
-
-    y=np.arange(0,hout)*stride+offset
-    x=np.arange(0,wout)*stride+offset
-       
-    # fast - vectorize
-    # meshgrid(x,y)=>(shape_y*shape_x)
-    y_vec=(y-center_y)**2
-    x_vec=(x-center_x)**2
-    xv, yv = np.meshgrid(x_vec, y_vec)
-    arr_sum = exp_factor * (xv + yv)
-    arr_exp = np.exp(-arr_sum)
-    arr_exp[arr_sum > thresh] = 0
-    heatmap[plane_idx,:,:]=np.maximum(heatmap[plane_idx,:,:],arr_exp)
+    for part_idx in range(0, n_kpt):
+        for person_idx in range(0, n_person):
+            center_x = kpts[person_idx, part_idx, 0]
+            center_y = kpts[person_idx, part_idx, 1]
+            if center_x < 0 or center_y < 0:
+                continue
+            for y in range(0, hout):
+                y_dist = (y*stride+offset-center_y)**2
+                for x in range(0, wout):
+                    x_dist = (x*stride+offset-center_x)**2
+                    arr_sum = exp_factor*(x_dist+y_dist)
+                    if arr_sum > thresh:
+                        continue
+                    arr_exp = math.exp(-arr_sum)
+                    if arr_exp > heatmap[part_idx, y, x]:
+                        heatmap[part_idx, y, x] = arr_exp
     return heatmap
 
-
 def get_paf_map(annos, height, width , hout, wout, parts, limbs, data_format="channels_first"):
     """
 
@@ -102,29 +94,56 @@ def get_paf_map(annos, height, width , hout, wout, parts, limbs, data_format="ch
     stride=height/hout
     vectormap = np.zeros((2*n_limbs, hout, wout), dtype=np.float32)
     counter = np.zeros((n_limbs, hout, wout), dtype=np.int16)
-
-
-    for joint in annos:
-        for i, (a, b) in enumerate(limbs):
-            # exclude invisible or unmarked point
-            if joint[a][0] < -100 or joint[a][1] < -100 or joint[b][0] < -100 or joint[b][1] < -100:
-                continue
-            v_start=np.array(joint[a])/stride
-            v_end=np.array(joint[b])/stride
-            vectormap = cal_vectormap_fast(vectormap, counter, i, v_start, v_end)
-
-    # normalize the PAF (otherwise longer limb gives stronger absolute strength)
-    for i in range(0,n_limbs):
-        filter_counter=np.where(counter[i]<=0,1,0)
-        div_counter=filter_counter+(1-filter_counter)*counter[i]
-        vectormap[i*2+0]/=div_counter
-        vectormap[i*2+1]/=div_counter
+    build_paf_map(annos_to_kpts(annos), np.array(limbs, dtype=np.int64).reshape(-1,2), stride, vectormap, counter)
 
     #resize
     if(data_format=="channels_last"):
         vectormap=np.transpose(vectormap,[1,2,0])
     return vectormap
 
+@numba.njit(fastmath=True, cache=True, nogil=True)
+def build_paf_map(kpts, limbs, stride, vectormap, counter):
+    """accumulate the unit vectors of all limbs onto vectormap, then normalize by counter"""
+    n_person, n_limbs = kpts.shape[0], limbs.shape[0]
+    hout, wout = vectormap.shape[1], vectormap.shape[2]
+    threshold = 1
+    for limb_idx in range(0, n_limbs):
+        src_idx, dst_idx = limbs[limb_idx, 0], limbs[limb_idx, 1]
+        for person_idx in range(0, n_person):
+            src_x, src_y = kpts[person_idx, src_idx, 0], kpts[person_idx, src_idx, 1]
+            dst_x, dst_y = kpts[person_idx, dst_idx, 0], kpts[person_idx, dst_idx, 1]
+            # exclude invisible or unmarked point
+            if src_x < -100 or src_y < -100 or dst_x < -100 or dst_y < -100:
+                continue
+            src_x, src_y, dst_x, dst_y = src_x/stride, src_y/stride, dst_x/stride, dst_y/stride
+            vector_x = dst_x-src_x
+            vector_y = dst_y-src_y
+            length = math.sqrt(vector_x**2 + vector_y**2)
+            if length == 0:
+                continue
+            min_x = max(0, int(np.round(min(src_x, dst_x) - threshold)))
+            min_y = max(0, int(np.round(min(src_y, dst_y) - threshold)))
+            max_x = min(wout, int(np.round(max(src_x, dst_x) + threshold)))
+            max_y = min(hout, int(np.round(max(src_y, dst_y) + threshold)))
+            norm_x = vector_x / length
+            norm_y = vector_y / length
+            for y in range(min_y, max_y):
+                for x in range(min_x, max_x):
+                    # orthogonal distance is < then threshold
+                    dist = abs((x-src_x)*norm_y - (y-src_y)*norm_x)
+                    if dist > threshold:
+                        continue
+                    counter[limb_idx, y, x] += 1
+                    vectormap[limb_idx*2+0, y, x] += norm_x
+                    vectormap[limb_idx*2+1, y, x] += norm_y
+        # normalize the PAF (otherwise longer limb gives stronger absolute strength)
+        for y in range(0, hout):
+            for x in range(0, wout):
+                if counter[limb_idx, y, x] > 0:
+                    vectormap[limb_idx*2+0, y, x] /= counter[limb_idx, y, x]
+                    vectormap[limb_idx*2+1, y, x] /= counter[limb_idx, y, x]
+    return vectormap
+
 def cal_vectormap_ori(vectormap, countmap, i, v_start, v_end):
     """
 
@@ -171,50 +190,6 @@ def cal_vectormap_ori(vectormap, countmap, i, v_start, v_end):
     return vectormap
 
 
-def cal_vectormap_fast(vectormap, countmap, i, v_start, v_end):
-    """
-
-    Parameters
-    -----------
-
-
-    Returns
-    --------
-
-
-    """
-    _, hout, wout = vectormap.shape[:3]
-
-    threshold = 1
-    vector_x = v_end[0] - v_start[0]
-    vector_y = v_end[1] - v_start[1]
-
-    length = math.sqrt(vector_x**2 + vector_y**2)
-    if length == 0:
-        return vectormap
-
-    min_x = max(0, int(np.round(min(v_start[0], v_end[0]) - threshold)))
-    min_y = max(0, int(np.round(min(v_start[1], v_end[1]) - threshold)))
-
-    max_x = min(wout, int(np.round(max(v_start[0], v_end[0]) + threshold)))
-    max_y = min(hout, int(np.round(max(v_start[1], v_end[1]) + threshold)))
-
-    norm_x = vector_x / length
-    norm_y = vector_y / length
-
-    x_vec = (np.arange(min_x, max_x) - v_start[0]) * norm_y
-    y_vec = (np.arange(min_y, max_y) - v_start[1]) * norm_x
-
-    xv, yv = np.meshgrid(x_vec, y_vec)
-
-    dist_matrix = abs(xv - yv)
-    filter_matrix = np.where(dist_matrix > threshold, 0, 1)
-    countmap[i, min_y:max_y, min_x:max_x] += filter_matrix
-
-    vectormap[i*2+0,min_y:max_y,min_x:max_x]+=norm_x*filter_matrix
-    vectormap[i*2+1,min_y:max_y,min_x:max_x]+=norm_y*filter_matrix
-    return vectormap
-
 def draw_results(images, heats_ground, heats_result, pafs_ground, pafs_result, masks, save_dir ,name='', data_format="channels_first"):
     """Save results for debugging.
 
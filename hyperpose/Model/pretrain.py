@@ -47,6 +47,7 @@ def single_pretrain(model,dataset,config):
     save_interval=config.pretrain.save_interval
     pretrain_model_dir=config.pretrain.pretrain_model_dir
     weight_decay_factor=config.pretrain.weight_decay_factor
+    xla_flag=config.pretrain.xla_flag
 
     print(f"starting to pretrain model backbone with learning rate:{lr_init} batch_size:{batch_size}")
     print(f"pretraining model_type:{config.model.model_type} model_backbone:{model.backbone.name}")
@@ -81,10 +82,9 @@ def single_pretrain(model,dataset,config):
     max_eval_acc=0
     stuck_time=0
 
-    #optimize one step
-    @tf.function
-    def one_step(image,label,train_model):
-        step.assign_add(1)
+    #calculate gradients of one step, compiled by XLA if enabled
+    @tf.function(experimental_compile=xla_flag)
+    def compute_gradients(image,label,train_model):
         with tf.GradientTape() as tape:
             predict=train_model.forward(image)
             pd_loss=train_model.cal_loss(label,predict)
@@ -94,11 +94,18 @@ def single_pretrain(model,dataset,config):
         top1_acc_num=tf.reduce_sum(tf.where(tf.math.in_top_k(label,predict,1),1,0))
         top5_acc_num=tf.reduce_sum(tf.where(tf.math.in_top_k(label,predict,5),1,0))
         gradients=tape.gradient(total_loss,train_model.trainable_weights)
+        return gradients,top1_acc_num,top5_acc_num,pd_loss,re_loss,predict
+
+    #optimize one step, optimizer slots are created outside the XLA cluster
+    @tf.function
+    def one_step(image,label,train_model):
+        step.assign_add(1)
+        gradients,top1_acc_num,top5_acc_num,pd_loss,re_loss,predict=compute_gradients(image,label,train_model)
         opt.apply_gradients(zip(gradients,train_model.trainable_weights))
         return top1_acc_num,top5_acc_num,pd_loss,re_loss,predict
     
     for image,label in train_dataset:
-        top1_acc_num,top5_acc_num,pd_loss,re_loss,predict=one_step(image.numpy(),label.numpy(),train_model)
+        top1_acc_num,top5_acc_num,pd_loss,re_loss,predict=one_step(image,label,train_model)
         total_pd_loss+=pd_loss/log_interval
         total_re_loss+=re_loss/log_interval
         total_top1_acc_num+=top1_acc_num
@@ -152,7 +159,7 @@ def single_val(val_model,dataset,config):
     val_dataset = val_dataset.prefetch(64)
 
     total_top1_acc_num,total_top5_acc_num,total_img_num=0,0,0
-    @tf.function
+    @tf.function(experimental_compile=config.pretrain.xla_flag)
     def one_step(image,label,val_model):
         predict=val_model.forward(image)
         val_top1_acc_num=tf.reduce_sum(tf.where(tf.math.in_top_k(label,predict,1),1,0))
@@ -160,7 +167,7 @@ def single_val(val_model,dataset,config):
         return val_top1_acc_num,val_top5_acc_num
     
     for image,label in val_dataset:
-        top1_acc_num,top5_acc_num=one_step(image.numpy(),label.numpy(),val_model)
+        top1_acc_num,top5_acc_num=one_step(image,label,val_model)
         total_top1_acc_num+=top1_acc_num
         total_top5_acc_num+=top5_acc_num
         total_img_num+=image.shape[0]
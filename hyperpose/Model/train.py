@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 import os
+import bisect
+import hashlib
 from tqdm import tqdm
 import numpy as np
 import matplotlib
@@ -7,82 +9,129 @@ matplotlib.use('Agg')
 import tensorflow as tf
 import tensorlayer as tl
 import _pickle as cPickle
-from functools import partial, reduce
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 from .common import KUNGFU
 from .common import log_train as log
 from .domainadapt import Discriminator
-from .common import decode_mask,get_num_parallel_calls
-from .metrics import MetricManager
+from .common import decode_mask
+from .metrics import MetricManager, MetricRecorder
 from .augmentor import BasicAugmentor
 from .processor import BasicPreProcessor
 from .processor import BasicPostProcessor
 from .processor import BasicVisualizer
-from .common import to_tensor_dict
 
+TRAIN_LOG_FMT = "Train Epoch={epoch_idx} / {total_epoch}, Step={step} / {total_step}: learning_rate: {lr:.6e} {timing}\n{metrics} "
 
-def _data_aug_fn(image, ground_truth, augmentor:BasicAugmentor, preprocessor:BasicPreProcessor, data_format="channels_first"):
-    """Data augmentation function."""
-    # restore data
-    image = image.numpy()
-    ground_truth = cPickle.loads(ground_truth.numpy())
-    annos = ground_truth["kpt"]
-    meta_mask = ground_truth["mask"]
-    bbxs = ground_truth["bbxs"]
 
-    # decode mask
-    mask = decode_mask(meta_mask)
-    if(mask is None):
-        mask = np.ones_like(image)[:,:,0].astype(np.uint8)
+def get_data_aug_fn(augmentor:BasicAugmentor, preprocessor:BasicPreProcessor, data_format="channels_first"):
+    """Build the data augmentation function, with the per-sample methods bound as closure locals."""
+    loads = cPickle.loads
+    aug_process = augmentor.process
+    pre_process = preprocessor.process
 
-    # general augmentaton process
-    image, annos, mask, bbxs = augmentor.process(image=image, annos=annos, mask=mask, bbxs=bbxs)
-    mask = mask[:,:,np.newaxis]
-    image = image * mask
+    def data_aug_fn(image, mask, ground_truth):
+        """Data augmentation function."""
+        # restore data, the mask is already decoded
+        ground_truth = loads(ground_truth)
+        annos = ground_truth["kpt"]
+        bbxs = ground_truth["bbxs"]
 
-    # TODO: all process are in channels_first format
-    image = np.transpose(image, [2, 0, 1])
-    mask = np.transpose(mask, [2, 0, 1])
+        # general augmentaton process, image stays in uint8 until the spatial transforms are done
+        image, annos, mask, bbxs = aug_process(image=image, annos=annos, mask=mask, bbxs=bbxs)
+        # mask out the unannotated regions while still in uint8, mask values are either 0 or 1
+        image = image * mask[:,:,np.newaxis]
+        image = image.astype(np.float32)/255.0
 
-    # generate result including heatmap and vectormap
-    target_x = preprocessor.process(annos=annos, mask=mask, bbxs=bbxs)
-    target_x = cPickle.dumps(target_x)
+        # generate result including heatmap and vectormap, preprocessor takes mask in channels_first format
+        target_x = pre_process(annos=annos, mask=mask[np.newaxis,:,:], bbxs=bbxs)
+        target_x = {key:np.asarray(value, dtype=np.float32) for key,value in target_x.items()}
 
-    return image, mask, target_x
+        # image and mask are transposed to channels_first format in the tf pipeline
+        return image, mask[:,:,np.newaxis].astype(np.float32), target_x
 
+    return data_aug_fn
 
-def _map_fn(img_list, annos, data_aug_fn):
-    """TF Dataset pipeline."""
+def _flat_data_aug_fn(image, mask, ground_truth, data_aug_fn, target_keys):
+    """Data augmentation function with targets flattened in the order of target_keys."""
+    image, mask, target_x = data_aug_fn(image, mask, ground_truth)
+    return [image, mask]+[target_x[key] for key in target_keys]
 
-    # load data
-    image = tf.io.read_file(img_list)
-    image = tf.image.decode_jpeg(image, channels=3)  # get RGB with 0~1
-    image = tf.image.convert_image_dtype(image, dtype=tf.float32)
+def _read_image(img_path):
+    image = tf.io.read_file(img_path)
+    # get RGB in uint8, float conversion is deferred after augmentation
+    image = tf.io.decode_jpeg(image, channels=3, dct_method="INTEGER_FAST")
+    return image
+
+def _decode_mask_fn(ground_truth, image_shape):
+    """Decode the mask of the unannotated regions, the whole image is kept if there is no mask."""
+    mask = decode_mask(cPickle.loads(ground_truth)["mask"])
+    if(mask is None):
+        mask = np.ones(shape=image_shape[:2], dtype=np.uint8)
+    return mask
+
+def _decode_map_fn(img_path, annos):
+    """TF Dataset decoding stage, cacheable since it is independent of the random augmentation."""
+    image = _read_image(img_path)
+    mask = tf.numpy_function(_decode_mask_fn, [annos, tf.shape(image)], tf.uint8)
+    mask.set_shape([None, None])
+    return image, mask, annos
+
+def _map_fn(image, mask, annos, data_aug_fn, target_spec, hin, win):
+    """TF Dataset pipeline."""
 
     # data augmentation using affine transform and get paf maps
-    image, mask, target_x= tf.py_function(data_aug_fn, [image, annos],
-                                                    [tf.float32, tf.float32, tf.string])
+    result = tf.numpy_function(data_aug_fn, [image, mask, annos], [tf.float32]*(2+len(target_spec)))
+    image, mask, target_list = result[0], result[1], result[2:]
+    image.set_shape([hin, win, 3])
+    mask.set_shape([hin, win, 1])
+    target_x = {}
+    for (key, shape), target in zip(target_spec.items(), target_list):
+        target.set_shape(shape)
+        target_x[key] = target
 
-    # data augmentaion using tf
-    image = tf.image.random_brightness(image, max_delta=35. / 255.)  # 64./255. 32./255.)  caffe -30~50
-    image = tf.image.random_contrast(image, lower=0.5, upper=1.5)  # lower=0.2, upper=1.8)  caffe 0.3~1.5
+    return image, mask, target_x
+
+def get_target_spec(train_dataset, data_aug_fn):
+    """Get the shape of each target generated by the preprocessor, by processing the first training sample."""
+    image, mask, annos = _decode_map_fn(*next(iter(train_dataset)))
+    _, _, target_x = data_aug_fn(image.numpy(), mask.numpy(), annos.numpy())
+    return {key:value.shape for key,value in target_x.items()}
+
+def _tf_aug_fn(image, mask, target_x):
+    """TF-native data augmentation, applicable to both single images and image batches."""
+    # data augmentaion using tf, random factors are drawn for each image
+    factor_shape = tf.concat([tf.shape(image)[:-3], [1, 1, 1]], axis=0)
+    brightness_delta = tf.random.uniform(factor_shape, minval=-35. / 255., maxval=35. / 255.)  # 64./255. 32./255.)  caffe -30~50
+    contrast_factor = tf.random.uniform(factor_shape, minval=0.5, maxval=1.5)  # lower=0.2, upper=1.8)  caffe 0.3~1.5
+    image = image + brightness_delta
+    image_mean = tf.reduce_mean(image, axis=[-3, -2], keepdims=True)
+    image = (image - image_mean) * contrast_factor + image_mean
     image = tf.clip_by_value(image, clip_value_min=0.0, clip_value_max=1.0)
 
+    # TODO: all process are in channels_first format
+    perm = [0, 3, 1, 2] if (image.shape.rank == 4) else [2, 0, 1]
+    image = tf.transpose(image, perm)
+    mask = tf.transpose(mask, perm)
+
     return image, mask, target_x
 
-def get_paramed_map_fn(augmentor, preprocessor, data_format="channels_first"):
-    paramed_data_aug_fn = partial(_data_aug_fn, augmentor=augmentor, preprocessor=preprocessor, data_format=data_format)
-    paramed_map_fn = partial(_map_fn, data_aug_fn=paramed_data_aug_fn)
+def get_paramed_map_fn(augmentor, preprocessor, train_dataset, data_format="channels_first"):
+    paramed_data_aug_fn = get_data_aug_fn(augmentor=augmentor, preprocessor=preprocessor, data_format=data_format)
+    # numpy_function needs the number and the shapes of the targets beforehand
+    target_spec = get_target_spec(train_dataset, paramed_data_aug_fn)
+    paramed_flat_data_aug_fn = partial(_flat_data_aug_fn, data_aug_fn=paramed_data_aug_fn, target_keys=list(target_spec.keys()))
+    paramed_map_fn = partial(_map_fn, data_aug_fn=paramed_flat_data_aug_fn, target_spec=target_spec, hin=augmentor.hin, win=augmentor.win)
     return paramed_map_fn
 
 def _dmadapt_data_aug_fn(image, augmentor, data_format="channels_first"):
-    image = image.numpy()
     image = augmentor.process_only_image(image)
     if(data_format=="channels_first"):
         image = np.transpose(image, [2,0,1])
-    return image
+    return image.astype(np.float32)
 
 def _dmadapt_map_fn(image, aug_fn):
-    image = tf.py_function(aug_fn, [image], tf.float32)
+    image = tf.numpy_function(aug_fn, [image], tf.float32)
     return image
 
 def get_paramed_dmadapt_map_fn(augmentor):
@@ -90,6 +139,78 @@ def get_paramed_dmadapt_map_fn(augmentor):
     paramed_dmadpat_map_fn = partial(_dmadapt_map_fn, aug_fn=paramed_dmadapt_aug_fn)
     return paramed_dmadpat_map_fn
 
+def get_snapshot_path(train_dataset, snapshot_dir):
+    """Get the snapshot path keyed by the content of the training dataset.
+
+    the snapshot fingerprint of tf.data doesn't cover the data yielded by the dataset generator, thus the
+    image paths and annotations are hashed to avoid reading a snapshot of another dataset. the generator
+    shuffles the samples in each run, so the per-sample digests are sorted to make the key order-independent.
+    """
+    sample_digests = []
+    for img_path, annos in train_dataset.as_numpy_iterator():
+        sample_digests.append(hashlib.md5(img_path+annos).digest())
+    dataset_key = hashlib.md5(b"".join(sorted(sample_digests))).hexdigest()
+    return os.path.join(snapshot_dir, dataset_key)
+
+def get_decoded_train_dataset(train_dataset, snapshot_dir=None):
+    """Decode, shuffle and repeat the training dataset, snapshotting the decoded images and masks if snapshot_dir is set."""
+    if(snapshot_dir is None):
+        train_dataset = train_dataset.shuffle(buffer_size=4096).repeat()
+        train_dataset = train_dataset.map(_decode_map_fn, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    else:
+        snapshot_path = get_snapshot_path(train_dataset, snapshot_dir)
+        log(f"snapshotting decoded training images to {snapshot_path}")
+        # jpegs and masks are decoded once in the first epoch, the following epochs read them back sequentially
+        train_dataset = train_dataset.map(_decode_map_fn, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        train_dataset = train_dataset.apply(tf.data.experimental.snapshot(snapshot_path, compression="AUTO"))
+        # the shuffle buffer holds decoded images now, the file list is already shuffled by the dataset
+        train_dataset = train_dataset.shuffle(buffer_size=512).repeat()
+    return train_dataset
+
+def _savez_atomic(save_path, **weight_dict):
+    """Write the npz file to a temporary file beside save_path and then move it onto save_path, thus an interrupted writing never leaves a truncated file."""
+    tmp_path = f"{save_path}.tmp"
+    with open(tmp_path, "wb") as tmp_file:
+        np.savez(tmp_file, **weight_dict)
+        tmp_file.flush()
+        os.fsync(tmp_file.fileno())
+    os.replace(tmp_path, save_path)
+
+def save_weights_async(saver_pool, model, save_path, format="npz_dict", name="model"):
+    """Save the model weights in tensorlayer npz or npz_dict format with a background thread.
+
+    the weights are copied to host memory before returning, thus the following training steps
+    can update them while the file is being written.
+    """
+    if(format=="npz_dict"):
+        weight_dict = {weight.name:weight.numpy() for weight in model.all_weights}
+    else:
+        # weights of different shapes are stored in one object array, as tl.files.save_npz does
+        params = np.empty(shape=len(model.all_weights), dtype=object)
+        for weight_idx, weight in enumerate(model.all_weights):
+            params[weight_idx] = weight.numpy()
+        weight_dict = {"params":params}
+
+    def log_saved(future):
+        if(future.exception() is None):
+            log(f"{name} save_path:{save_path} saved!\n")
+        else:
+            log(f"{name} save_path:{save_path} saving failed: {future.exception()}\n")
+
+    save_future = saver_pool.submit(_savez_atomic, save_path, **weight_dict)
+    save_future.add_done_callback(log_saved)
+    return save_future
+
+def get_train_dataset_options():
+    options = tf.data.Options()
+    options.experimental_optimization.map_vectorization.enabled = True
+    options.experimental_optimization.map_and_batch_fusion = True
+    options.experimental_optimization.map_fusion = True
+    options.experimental_optimization.parallel_batch = True
+    # training samples are shuffled anyway, let the parallel maps yield out of order instead of waiting on stragglers
+    options.experimental_deterministic = False
+    return options
+
 
 def single_train(train_model, dataset, config, augmentor:BasicAugmentor, \
                     preprocessor:BasicPreProcessor,postprocessor:BasicPostProcessor,visualizer:BasicVisualizer):
@@ -142,11 +263,13 @@ def single_train(train_model, dataset, config, augmentor:BasicAugmentor, \
     # initializing train dataset
     train_dataset = dataset.get_train_dataset()
     epoch_size = dataset.get_train_datasize()//batch_size
-    paramed_map_fn = get_paramed_map_fn(augmentor=augmentor, preprocessor=preprocessor, data_format=data_format)
-    train_dataset = train_dataset.shuffle(buffer_size=4096).repeat()
-    train_dataset = train_dataset.map(paramed_map_fn, num_parallel_calls=get_num_parallel_calls())
-    train_dataset = train_dataset.batch(config.train.batch_size)
-    train_dataset = train_dataset.prefetch(3)
+    paramed_map_fn = get_paramed_map_fn(augmentor=augmentor, preprocessor=preprocessor, train_dataset=train_dataset, data_format=data_format)
+    train_dataset = get_decoded_train_dataset(train_dataset, snapshot_dir=config.data.snapshot_dir)
+    train_dataset = train_dataset.map(paramed_map_fn, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    train_dataset = train_dataset.batch(config.train.batch_size, drop_remainder=True)
+    train_dataset = train_dataset.map(_tf_aug_fn, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    train_dataset = train_dataset.prefetch(tf.data.experimental.AUTOTUNE)
+    train_dataset = train_dataset.with_options(get_train_dataset_options())
     train_dataset_iter = iter(train_dataset)
 
     #train configure
@@ -154,6 +277,12 @@ def single_train(train_model, dataset, config, augmentor:BasicAugmentor, \
     save_lr = tf.Variable(lr_init, trainable=False)
     opt = tf.keras.optimizers.Adam(learning_rate=save_lr)
     domainadapt_flag = config.data.domainadapt_flag
+    xla_flag = config.train.xla_flag
+    mixed_precision_flag = config.train.mixed_precision_flag
+    if(mixed_precision_flag and xla_flag):
+        # grappler doesn't rewrite xla compiled functions into float16
+        log("Mixed precision graph rewrite doesn't apply to XLA compiled functions, XLA is disabled!")
+        xla_flag = False
     total_epoch = total_step//epoch_size
 
     #domain adaptation params
@@ -173,15 +302,17 @@ def single_train(train_model, dataset, config, augmentor:BasicAugmentor, \
         # construct domain adaptation dataset
         dmadapt_train_dataset = dataset.get_dmadapt_train_dataset()
         paramed_dmadapt_map_fn = get_paramed_dmadapt_map_fn(augmentor)
-        dmadapt_train_dataset = dmadapt_train_dataset.map(paramed_dmadapt_map_fn, num_parallel_calls=get_num_parallel_calls())
+        dmadapt_train_dataset = dmadapt_train_dataset.map(paramed_dmadapt_map_fn, num_parallel_calls=tf.data.experimental.AUTOTUNE)
         dmadapt_train_dataset = dmadapt_train_dataset.shuffle(buffer_size=4096).repeat()
         dmadapt_train_dataset = dmadapt_train_dataset.batch(config.train.batch_size)
-        dmadapt_train_dataset = dmadapt_train_dataset.prefetch(3)
+        dmadapt_train_dataset = dmadapt_train_dataset.prefetch(tf.data.experimental.AUTOTUNE)
         dmadapt_train_dataset_iter = iter(dmadapt_train_dataset)
 
 
     #load from ckpt
     ckpt_manager = tf.train.CheckpointManager(ckpt, model_dir, max_to_keep=3)
+    # npz weights are written in background, one file at a time
+    saver_pool = ThreadPoolExecutor(max_workers=1)
     try:
         log("loading ckpt...")
         ckpt.restore(ckpt_manager.latest_checkpoint)
@@ -207,33 +338,50 @@ def single_train(train_model, dataset, config, augmentor:BasicAugmentor, \
             log("discriminator path doesn't exist, discriminator parameters are initialized")
 
     
+    # mixed precision, the loss scaling optimizer wraps the optimizer tracked by ckpt
+    if(mixed_precision_flag):
+        log("Mixed precision training enabled!")
+        opt = tf.train.experimental.enable_mixed_precision_graph_rewrite(opt, loss_scale="dynamic")
+        loss_scale_opt = opt
+
     log(f"single training using learning rate:{lr_init} batch_size:{batch_size}")
     step = save_step.numpy()
-    lr = save_lr.numpy()
-
-    for lr_decay_step in lr_decay_steps:
-        if (step > lr_decay_step):
-            lr = lr * lr_decay_factor
-
-    # optimize one step
-    def optimize_step(image, mask, target_x, train_model, metric_manager: MetricManager):
+    # learning rate of the current step, recomputed only when a decay step is reached
+    lr_decay_set = set(lr_decay_steps)
+    lr = lr_init * lr_decay_factor**bisect.bisect_right(lr_decay_steps, step)
+    save_lr.assign(lr)
+
+    # calculate gradients of one step, compiled by XLA if enabled
+    @tf.function(experimental_compile=xla_flag)
+    def compute_gradients(image, mask, target_x):
+        metric_recorder = MetricRecorder()
         # tape
         with tf.GradientTape() as tape:
             predict_x = train_model.forward(x=image, is_train=True, ret_backbone=domainadapt_flag)
             total_loss = train_model.cal_loss(predict_x=predict_x, target_x=target_x, \
-                                                        mask=mask, metric_manager=metric_manager)
-        # optimize model
+                                                        mask=mask, metric_manager=metric_recorder)
+            if(mixed_precision_flag):
+                total_loss = loss_scale_opt.get_scaled_loss(total_loss)
         gradients = tape.gradient(total_loss, train_model.trainable_weights)
+        if(mixed_precision_flag):
+            gradients = loss_scale_opt.get_unscaled_gradients(gradients)
+        return predict_x, gradients, metric_recorder.metric_dict
+
+    # optimize one step
+    @tf.function(experimental_relax_shapes=True)
+    def optimize_step(image, mask, target_x):
+        predict_x, gradients, metric_dict = compute_gradients(image, mask, target_x)
+        # optimize model
         opt.apply_gradients(zip(gradients, train_model.trainable_weights))
-        return predict_x
+        return predict_x, metric_dict
     
-    def optimize_step_dmadapt(image_src, image_dst, train_model, adapt_dis: Discriminator, metric_manager: MetricManager):
+    def optimize_step_dmadapt(backbone_feature_src, image_dst, train_model, adapt_dis: Discriminator, metric_manager: MetricManager):
+        # src feature is reused from the model optimization step, it only trains the discriminator
+        backbone_feature_src = tf.stop_gradient(backbone_feature_src)
         # tape
         with tf.GradientTape(persistent=True) as tape:
             # feature extraction
             # src feature
-            predict_src = train_model.forward(x=image_src, is_train=True, ret_backbone=True)
-            backbone_feature_src = predict_src["backbone_features"]
             adapt_pd_src = adapt_dis.forward(backbone_feature_src)
             # dst feature
             predict_dst = train_model.forward(x=image_dst, is_train=True, ret_backbone=True)
@@ -267,37 +415,37 @@ def single_train(train_model, dataset, config, augmentor:BasicAugmentor, \
     log(f"Start Training- total_epoch: {total_epoch} total_step: {total_step} current_epoch:{cur_epoch} "\
         +f"current_step:{step} batch_size:{batch_size} lr_init:{lr_init} lr_decay_steps:{lr_decay_steps} "\
         +f"lr_decay_factor:{lr_decay_factor} weight_decay_factor:{weight_decay_factor}" )
+    # timing is reported as the average step time since the timer last started
+    start_step = step
+    metric_manager.start_timing()
+    timing_step = step
+    train_log_fmt = TRAIN_LOG_FMT
     for epoch_idx in range(cur_epoch,total_epoch):
         log(f"Epoch {epoch_idx}/{total_epoch}:")
-        for _ in tqdm(range(0,epoch_size)):
+        # rate-limit the progress bar refreshing
+        for _ in tqdm(range(0,epoch_size), miniters=max(1, log_interval//4), mininterval=1.0):
             step+=1
-            metric_manager.start_timing()
-            image, mask, target_list = next(train_dataset_iter)
-            # extract gt_label
-            target_list = [cPickle.loads(target) for target in target_list.numpy()]
-            target_x = {key:[] for key,value in target_list[0].items()}
-            target_x = reduce(lambda x, y: {key:x[key]+[y[key]] for key,value in x.items()},[target_x]+target_list)
-            target_x = {key:np.stack(value) for key,value in target_x.items()}
-            target_x = to_tensor_dict(target_x)
+            image, mask, target_x = next(train_dataset_iter)
 
             # learning rate decay
-            if (step in lr_decay_steps):
-                new_lr_decay = lr_decay_factor**(lr_decay_steps.index(step) + 1)
-                lr = lr_init * new_lr_decay
+            if (step in lr_decay_set):
+                lr = lr_init * lr_decay_factor**bisect.bisect_right(lr_decay_steps, step)
+                save_lr.assign(lr)
 
             # optimize one step
-            predict_x = optimize_step(image, mask, target_x, train_model, metric_manager)
+            predict_x, metric_dict = optimize_step(image, mask, target_x)
+            metric_manager.update_dict(metric_dict)
 
             # optimize domain adaptation
             if(domainadapt_flag):
-                src_image = image
                 dst_image = next(dmadapt_train_dataset_iter)
-                predict_dst = optimize_step_dmadapt(src_image, dst_image, train_model, adapt_dis, metric_manager)
+                predict_dst = optimize_step_dmadapt(predict_x["backbone_features"], dst_image, train_model, adapt_dis, metric_manager)
 
             # log info periodly
             if ((step != 0) and (step % log_interval) == 0):
-                log(f"Train Epoch={epoch_idx} / {total_epoch}, Step={step} / {total_step}: learning_rate: {lr:.6e} {metric_manager.report_timing()}\n"\
-                        +f"{metric_manager.report_train()} ")
+                log(train_log_fmt.format(epoch_idx=epoch_idx, total_epoch=total_epoch, step=step, total_step=total_step, lr=lr, \
+                        timing=metric_manager.report_timing(step_num=max(1, step-timing_step)), metrics=metric_manager.report_train()))
+                timing_step = step
 
             # visualize periodly
             if ((step != 0) and (step % vis_interval) == 0):
@@ -311,18 +459,23 @@ def single_train(train_model, dataset, config, augmentor:BasicAugmentor, \
                 # save ckpt
                 log("saving model ckpt and result...")
                 save_step.assign(step)
-                save_lr.assign(lr)
                 ckpt_save_path = ckpt_manager.save()
                 log(f"ckpt save_path:{ckpt_save_path} saved!\n")
                 # save train model
                 model_save_path = os.path.join(model_dir, "newest_model.npz")
-                train_model.save_weights(model_save_path, format="npz_dict")
-                log(f"model save_path:{model_save_path} saved!\n")
+                save_weights_async(saver_pool, train_model, model_save_path, name="model")
                 # save discriminator model
                 if (domainadapt_flag):
                     dis_save_path = os.path.join(model_dir, "newest_discriminator.npz")
-                    adapt_dis.save_weights(dis_save_path, format="npz_dict")
-                    log(f"discriminator save_path:{dis_save_path} saved!\n")
+                    save_weights_async(saver_pool, adapt_dis, dis_save_path, name="discriminator")
+
+            # restart timing to exclude the first traced step, visualizing and saving
+            if ((step == start_step+1) or (step % vis_interval) == 0 or (step % save_interval) == 0):
+                metric_manager.start_timing()
+                timing_step = step
+
+    # wait for the pending weight saving
+    saver_pool.shutdown(wait=True)
 
 def parallel_train(train_model, dataset, config, augmentor:BasicAugmentor, \
                         preprocessor:BasicPreProcessor,postprocessor:BasicPostProcessor,visualizer=BasicVisualizer):
@@ -381,11 +534,13 @@ def parallel_train(train_model, dataset, config, augmentor:BasicAugmentor, \
     # initializing train dataset
     train_dataset = dataset.get_train_dataset()
     epoch_size = dataset.get_train_datasize()//batch_size
-    paramed_map_fn = get_paramed_map_fn(augmentor=augmentor, preprocessor=preprocessor, data_format=data_format)
-    train_dataset = train_dataset.shuffle(buffer_size=4096).repeat()
-    train_dataset = train_dataset.map(paramed_map_fn, num_parallel_calls=get_num_parallel_calls())
-    train_dataset = train_dataset.batch(config.train.batch_size)
-    train_dataset = train_dataset.prefetch(3)
+    paramed_map_fn = get_paramed_map_fn(augmentor=augmentor, preprocessor=preprocessor, train_dataset=train_dataset, data_format=data_format)
+    train_dataset = get_decoded_train_dataset(train_dataset, snapshot_dir=config.data.snapshot_dir)
+    train_dataset = train_dataset.map(paramed_map_fn, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    train_dataset = train_dataset.batch(config.train.batch_size, drop_remainder=True)
+    train_dataset = train_dataset.map(_tf_aug_fn, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    train_dataset = train_dataset.prefetch(tf.data.experimental.AUTOTUNE)
+    train_dataset = train_dataset.with_options(get_train_dataset_options())
     train_dataset_iter = iter(train_dataset)
 
     #train configure
@@ -393,6 +548,12 @@ def parallel_train(train_model, dataset, config, augmentor:BasicAugmentor, \
     save_lr = tf.Variable(lr_init, trainable=False)
     opt = tf.keras.optimizers.Adam(learning_rate=save_lr)
     domainadapt_flag = config.data.domainadapt_flag
+    xla_flag = config.train.xla_flag
+    mixed_precision_flag = config.train.mixed_precision_flag
+    if(mixed_precision_flag and xla_flag):
+        # grappler doesn't rewrite xla compiled functions into float16
+        log("Mixed precision graph rewrite doesn't apply to XLA compiled functions, XLA is disabled!")
+        xla_flag = False
     total_epoch = total_step//epoch_size
 
     #domain adaptation params
@@ -412,15 +573,17 @@ def parallel_train(train_model, dataset, config, augmentor:BasicAugmentor, \
         # construct domain adaptation dataset
         dmadapt_train_dataset = dataset.get_dmadapt_train_dataset()
         paramed_dmadapt_map_fn = get_paramed_dmadapt_map_fn(augmentor)
-        dmadapt_train_dataset = dmadapt_train_dataset.map(paramed_dmadapt_map_fn, num_parallel_calls=get_num_parallel_calls())
+        dmadapt_train_dataset = dmadapt_train_dataset.map(paramed_dmadapt_map_fn, num_parallel_calls=tf.data.experimental.AUTOTUNE)
         dmadapt_train_dataset = dmadapt_train_dataset.shuffle(buffer_size=4096).repeat()
         dmadapt_train_dataset = dmadapt_train_dataset.batch(config.train.batch_size)
-        dmadapt_train_dataset = dmadapt_train_dataset.prefetch(3)
+        dmadapt_train_dataset = dmadapt_train_dataset.prefetch(tf.data.experimental.AUTOTUNE)
         dmadapt_train_dataset_iter = iter(dmadapt_train_dataset)
 
 
     #load from ckpt
     ckpt_manager = tf.train.CheckpointManager(ckpt, model_dir, max_to_keep=3)
+    # npz weights are written in background, one file at a time
+    saver_pool = ThreadPoolExecutor(max_workers=1)
     try:
         log("loading ckpt...")
         ckpt.restore(ckpt_manager.latest_checkpoint)
@@ -446,9 +609,14 @@ def parallel_train(train_model, dataset, config, augmentor:BasicAugmentor, \
             log("discriminator path doesn't exist, discriminator parameters are initialized")
 
     
+    # mixed precision, the loss scaling optimizer wraps the optimizer tracked by ckpt
+    if(mixed_precision_flag):
+        log("Mixed precision training enabled!")
+        opt = tf.train.experimental.enable_mixed_precision_graph_rewrite(opt, loss_scale="dynamic")
+        loss_scale_opt = opt
+
     log(f"Parallel training using learning rate:{lr_init} batch_size:{batch_size}")
     step = save_step.numpy()
-    lr = save_lr.numpy()
 
     #import kungfu
     from kungfu.python import current_cluster_size, current_rank
@@ -460,25 +628,42 @@ def parallel_train(train_model, dataset, config, augmentor:BasicAugmentor, \
     for step_idx, decay_step in enumerate(lr_decay_steps):
         lr_decay_steps[step_idx] = decay_step // current_cluster_size() + 1  # KungFu
 
-    # optimize one step
-    def optimize_step(image, mask, target_x, train_model, metric_manager: MetricManager):
+    # learning rate of the current step, recomputed only when a decay step is reached
+    lr_decay_set = set(lr_decay_steps)
+    lr = lr_init * lr_decay_factor**bisect.bisect_right(lr_decay_steps, step)
+    save_lr.assign(lr)
+
+    # calculate gradients of one step, compiled by XLA if enabled
+    @tf.function(experimental_compile=xla_flag)
+    def compute_gradients(image, mask, target_x):
+        metric_recorder = MetricRecorder()
         # tape
         with tf.GradientTape() as tape:
             predict_x = train_model.forward(x=image, is_train=True, ret_backbone=domainadapt_flag)
             total_loss = train_model.cal_loss(predict_x=predict_x, target_x=target_x, \
-                                                        mask=mask, metric_manager=metric_manager)
-        # optimize model
+                                                        mask=mask, metric_manager=metric_recorder)
+            if(mixed_precision_flag):
+                total_loss = loss_scale_opt.get_scaled_loss(total_loss)
         gradients = tape.gradient(total_loss, train_model.trainable_weights)
+        if(mixed_precision_flag):
+            gradients = loss_scale_opt.get_unscaled_gradients(gradients)
+        return predict_x, gradients, metric_recorder.metric_dict
+
+    # optimize one step
+    @tf.function(experimental_relax_shapes=True)
+    def optimize_step(image, mask, target_x):
+        predict_x, gradients, metric_dict = compute_gradients(image, mask, target_x)
+        # optimize model
         opt.apply_gradients(zip(gradients, train_model.trainable_weights))
-        return predict_x
+        return predict_x, metric_dict
     
-    def optimize_step_dmadapt(image_src, image_dst, train_model, adapt_dis: Discriminator, metric_manager: MetricManager):
+    def optimize_step_dmadapt(backbone_feature_src, image_dst, train_model, adapt_dis: Discriminator, metric_manager: MetricManager):
+        # src feature is reused from the model optimization step, it only trains the discriminator
+        backbone_feature_src = tf.stop_gradient(backbone_feature_src)
         # tape
         with tf.GradientTape(persistent=True) as tape:
             # feature extraction
             # src feature
-            predict_src = train_model.forward(x=image_src, is_train=True, ret_backbone=True)
-            backbone_feature_src = predict_src["backbone_features"]
             adapt_pd_src = adapt_dis.forward(backbone_feature_src)
             # dst feature
             predict_dst = train_model.forward(x=image_dst, is_train=True, ret_backbone=True)
@@ -526,33 +711,32 @@ def parallel_train(train_model, dataset, config, augmentor:BasicAugmentor, \
     log(f"Start Training- total_epoch: {total_epoch} total_step: {total_step} current_epoch:{cur_epoch} "\
         +f"current_step:{step} batch_size:{batch_size} lr_init:{lr_init} lr_decay_steps:{lr_decay_steps} "\
         +f"lr_decay_factor:{lr_decay_factor} weight_decay_factor:{weight_decay_factor}" )
+    # timing is reported as the average step time since the timer last started
+    start_step = step
+    metric_manager.start_timing()
+    timing_step = step
+    train_log_fmt = TRAIN_LOG_FMT
     for epoch_idx in range(cur_epoch,total_epoch):
         log(f"Epoch {epoch_idx}/{total_epoch}:")
-        for _ in tqdm(range(0,epoch_size)):
+        # rate-limit the progress bar refreshing
+        for _ in tqdm(range(0,epoch_size), miniters=max(1, log_interval//4), mininterval=1.0):
             step+=1
-            metric_manager.start_timing()
-            image, mask, target_list = next(train_dataset_iter)
-            # extract gt_label
-            target_list = [cPickle.loads(target) for target in target_list.numpy()]
-            target_x = {key:[] for key,value in target_list[0].items()}
-            target_x = reduce(lambda x, y: {key:x[key]+[y[key]] for key,value in x.items()},[target_x]+target_list)
-            target_x = {key:np.stack(value) for key,value in target_x.items()}            
-            target_x = to_tensor_dict(target_x)
+            image, mask, target_x = next(train_dataset_iter)
 
 
             # learning rate decay
-            if (step in lr_decay_steps):
-                new_lr_decay = lr_decay_factor**(lr_decay_steps.index(step) + 1)
-                lr = lr_init * new_lr_decay
+            if (step in lr_decay_set):
+                lr = lr_init * lr_decay_factor**bisect.bisect_right(lr_decay_steps, step)
+                save_lr.assign(lr)
 
             # optimize one step
-            predict_x = optimize_step(image, mask, target_x, train_model, metric_manager)
+            predict_x, metric_dict = optimize_step(image, mask, target_x)
+            metric_manager.update_dict(metric_dict)
 
             # optimize domain adaptation
             if(domainadapt_flag):
-                src_image = image
                 dst_image = next(dmadapt_train_dataset_iter)
-                predict_dst = optimize_step_dmadapt(src_image, dst_image, train_model, adapt_dis, metric_manager)
+                predict_dst = optimize_step_dmadapt(predict_x["backbone_features"], dst_image, train_model, adapt_dis, metric_manager)
             
             if(step==1):
                 broadcast_variables(train_model.all_weights)
@@ -560,8 +744,9 @@ def parallel_train(train_model, dataset, config, augmentor:BasicAugmentor, \
 
             # log info periodly
             if ((step != 0) and (step % log_interval) == 0):
-                log(f"Train Epoch={epoch_idx} / {total_epoch}, Step={step} / {total_step}: learning_rate: {lr:.6e} {metric_manager.report_timing()}\n"\
-                        +f"{metric_manager.report_train()} ")
+                log(train_log_fmt.format(epoch_idx=epoch_idx, total_epoch=total_epoch, step=step, total_step=total_step, lr=lr, \
+                        timing=metric_manager.report_timing(step_num=max(1, step-timing_step)), metrics=metric_manager.report_train()))
+                timing_step = step
 
             # visualize periodly
             if ((step != 0) and (step % vis_interval) == 0 and current_rank() == 0):
@@ -574,15 +759,20 @@ def parallel_train(train_model, dataset, config, augmentor:BasicAugmentor, \
                 # save ckpt
                 log("saving model ckpt and result...")
                 save_step.assign(step)
-                save_lr.assign(lr)
                 ckpt_save_path = ckpt_manager.save()
                 log(f"ckpt save_path:{ckpt_save_path} saved!\n")
                 # save train model
                 model_save_path = os.path.join(model_dir, "newest_model.npz")
-                train_model.save_weights(model_save_path)
-                log(f"model save_path:{model_save_path} saved!\n")
+                save_weights_async(saver_pool, train_model, model_save_path, format="npz", name="model")
                 # save discriminator model
                 if (domainadapt_flag):
                     dis_save_path = os.path.join(model_dir, "newest_discriminator.npz")
-                    adapt_dis.save_weights(dis_save_path)
-                    log(f"discriminator save_path:{dis_save_path} saved!\n")
\ No newline at end of file
+                    save_weights_async(saver_pool, adapt_dis, dis_save_path, format="npz", name="discriminator")
+
+            # restart timing to exclude the first traced step, visualizing and saving
+            if ((step == start_step+1) or (step % vis_interval) == 0 or (step % save_interval) == 0):
+                metric_manager.start_timing()
+                timing_step = step
+
+    # wait for the pending weight saving
+    saver_pool.shutdown(wait=True)
@@ -10,6 +10,7 @@ setup(
     install_requires=[
         "cython>=0.29",
         "numpy==1.16.4",
+        "numba>=0.48,<0.54",
         "easydict>=1.9,<=1.10",
         "opencv-python>=3.4,<3.5",
         "tensorflow==2.3.1",
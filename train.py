@@ -1,6 +1,9 @@
 #!/usr/bin/env python3
 
 import os
+# the parallel tf.data workers run the numpy augmentation, keep the blas of each worker single threaded
+os.environ.setdefault("OMP_NUM_THREADS", "1")
+os.environ.setdefault("MKL_NUM_THREADS", "1")
 import cv2
 import sys
 import math